@@ -1,5 +1,6 @@
 import dataclasses
 import datetime
+import functools
 import os
 import subprocess
 import sys
@@ -11,8 +12,10 @@ import string
 from pathlib import Path
 from textwrap import dedent
 from typing import (
+    Any,
     Callable,
     Dict,
+    Iterable,
     List,
     Optional,
 )
@@ -25,7 +28,15 @@ from .lib.process import (
     AsyncProcess,
     ProcessListener,
     OutputView,
+    CancellationInfo,
+    CancellationPolicy,
     CompletedProcessInfo,
+    JobServer,
+    MatrixRun,
+    close_shared_jobserver,
+    file_chunks,
+    shared_jobserver,
+    text_chunks,
 )
 
 
@@ -34,6 +45,83 @@ def log(*parts: str, **kwargs) -> None:
         print("[execpp]", *parts, **kwargs)
 
 
+def plugin_unloaded() -> None:
+    close_shared_jobserver()
+
+
+def settings() -> sublime.Settings:
+    return sublime.load_settings("execpp.sublime-settings")
+
+
+def cancellation_policy() -> CancellationPolicy:
+    known_fields = {field.name for field in dataclasses.fields(CancellationPolicy)}
+    grace_periods: Dict[str, float] = {}
+    for name, value in (settings().get("cancellation") or {}).items():
+        if name not in known_fields:
+            log("[execpp] Ignoring unknown cancellation setting", name)
+            continue
+        try:
+            grace_periods[name] = float(value)
+        except (TypeError, ValueError):
+            log("[execpp] Ignoring cancellation setting", name, "with value", value)
+    return CancellationPolicy(**grace_periods)
+
+
+def jobserver() -> Optional[JobServer]:
+    return shared_jobserver(settings().get("jobs"))
+
+
+def jobserver_auth() -> str:
+    return settings().get("jobserver_auth", "fifo")
+
+
+class ViewText:
+    """Text of a view fed to builds through stdin.
+
+    The text is taken once, on the main thread when the build starts, so edits
+    made while it is streamed cannot tear or shift what the build reads.
+    """
+
+    def __init__(self, view: sublime.View) -> None:
+        self.view = view
+        self._texts: Dict[str, List[str]] = {}
+
+    def texts(self, stdin: str) -> List[str]:
+        if stdin not in self._texts:
+            regions = []
+            if stdin == "selection":
+                regions = [region for region in self.view.sel() if not region.empty()]
+            # Without any selected text, the selection falls back to the buffer.
+            if not regions:
+                regions = [sublime.Region(0, self.view.size())]
+            self._texts[stdin] = [self.view.substr(region) for region in regions]
+        return self._texts[stdin]
+
+
+def stdin_source(
+    view_text: ViewText, stdin: str, cwd: Path
+) -> Optional[Callable[[], Iterable[bytes]]]:
+    if not stdin:
+        return None
+    elif stdin in ("buffer", "selection"):
+        texts = view_text.texts(stdin)
+        return lambda: text_chunks(texts)
+
+    stdin_file = cwd / Path(stdin).expanduser()
+    if not stdin_file.is_file():
+        raise ValueError(
+            f"stdin is neither buffer, selection nor an existing file: {stdin_file}"
+        )
+    return lambda: file_chunks(stdin_file)
+
+
+def scope_matches(window: sublime.Window, scope: str) -> bool:
+    return any(
+        window.active_view().match_selector(cursor.begin(), scope)
+        for cursor in window.active_view().sel()
+    )
+
+
 class SublimeProcessListener(ProcessListener):
     def __init__(self, view: OutputView) -> None:
         self.view = view
@@ -41,6 +129,9 @@ class SublimeProcessListener(ProcessListener):
     def on_data(self, text: str) -> None:
         self.view.append(text)
 
+    def on_cancelled(self, cancellation: CancellationInfo) -> None:
+        self.view.append(f"[{cancellation.message()}]\n")
+
     def on_finished(self, completed_process: CompletedProcessInfo) -> None:
         self.view.append(
             dedent(
@@ -97,28 +188,119 @@ class SublimeTabView(OutputView):
         )
 
 
-class ExecppCommand(sublime_plugin.WindowCommand):
+def output_view_form(window: sublime.Window, output_view_name: str) -> OutputView:
+    if not output_view_name:
+        return SublimeConsoleView(window)
+    elif output_view_name == "panel":
+        return SublimeConsoleView(window)
+    elif output_view_name == "tab":
+        return SublimeTabView(window)
+
+    raise ValueError(f"Unknown output view form name: {output_view_name}")
+
+
+def prepare_build(
+    window: sublime.Window,
+    command: List[str],
+    env: Dict[str, str],
+    variables: Dict[str, str],
+    working_dir: str,
+    stdin: str,
+    view_text: Optional[ViewText] = None,
+) -> Callable[[ProcessListener], AsyncProcess]:
+    """Resolve everything a build needs from Sublime Text, on the main thread.
+
+    The returned function only starts the process, and may be called from any
+    thread.
+    """
+    system_environment = os.environ.copy()
+    settings_environment = window.active_view().settings().get("build_env") or {}
+    sublime_build_system_variables = window.extract_variables()
+    process_environment = merge_and_substitute_environment_variables(
+        variables,
+        env,
+        sublime_build_system_variables,
+        settings_environment,
+        system_environment,
+    )
+    build_jobserver = jobserver()
+    pass_fds: List[int] = []
+    if build_jobserver is not None:
+        process_environment.update(
+            build_jobserver.environment(
+                jobserver_auth(), process_environment.get("MAKEFLAGS", "")
+            )
+        )
+        pass_fds = build_jobserver.pass_fds(jobserver_auth())
+
+    process_command = [
+        expand_variable(command_part, process_environment) for command_part in command
+    ]
+    process_cwd = Path(expand_variable(working_dir, process_environment))
+    process_stdin = stdin_source(
+        view_text or ViewText(window.active_view()),
+        expand_variable(stdin, process_environment),
+        process_cwd,
+    )
+
+    def start(listener: ProcessListener) -> AsyncProcess:
+        log("[execpp] Running", command, "from", process_cwd)
+        return AsyncProcess(
+            process_command,
+            process_environment,
+            process_cwd,
+            listener,
+            pass_fds=pass_fds,
+            stdin=process_stdin() if process_stdin else None,
+            jobserver=build_jobserver,
+        )
+
+    return start
+
+
+def starting_message() -> str:
+    return f"[execpp Starting {datetime.datetime.now(tz=datetime.timezone.utc).isoformat()}]\n"
+
+
+class CancellingWindowCommand(sublime_plugin.WindowCommand):
+    """Starts a build queued while cancelling another once the old one is reaped."""
+
     def __init__(self, window: sublime.Window) -> None:
         super().__init__(window)
 
         self.output_view: Optional[OutputView] = None
+        self.pending_build: Optional[Callable[[], None]] = None
+
+    def _on_reaped(self, cancellation: CancellationInfo) -> None:
+        log("[execpp]", cancellation.message())
+        sublime.set_timeout(lambda: self._run_pending_build(cancellation))
+
+    def _run_pending_build(self, cancellation: CancellationInfo) -> None:
+        pending_build, self.pending_build = self.pending_build, None
+        if pending_build is None:
+            return
+
+        if not cancellation.reaped:
+            if self.output_view is not None:
+                self.output_view.append(
+                    "[Not starting the new build, the cancelled one is still running]\n"
+                )
+            return
+
+        pending_build()
+
+
+class ExecppCommand(CancellingWindowCommand):
+    def __init__(self, window: sublime.Window) -> None:
+        super().__init__(window)
+
         self.build_process: Optional[AsyncProcess] = None
 
     def is_enabled(self, kill: bool = False, **kwargs: object) -> bool:
         if kill:
-            return bool(self.build_process and self.build_process.exit_code() is None)
+            return bool(self.build_process and self.build_process.is_active())
         return True
 
-    def _output_view_form(self, output_view_name: str) -> OutputView:
-        if not output_view_name:
-            return SublimeConsoleView(self.window)
-        elif output_view_name == "panel":
-            return SublimeConsoleView(self.window)
-        elif output_view_name == "tab":
-            return SublimeTabView(self.window)
-
-        raise ValueError(f"Unknown output view form name: {output_view_name}")
-
     def run(
         self,
         command: List[str] = [],
@@ -128,67 +310,157 @@ class ExecppCommand(sublime_plugin.WindowCommand):
         output_view: str = "panel",
         kill: bool = False,
         scope: str = "",
+        stdin: str = "",
     ) -> None:
         if kill and self.build_process and self.build_process.is_active():
             log("[execpp] Killing active process.")
+            self.pending_build = None
             self._kill_active_process()
             return
 
         if self.build_process and self.build_process.is_active():
-            log("[execpp] Process already on going. Canceling it.")
+            log("[execpp] Process already on going. Canceling it before starting.")
+            self.pending_build = functools.partial(
+                self.run,
+                command=command,
+                env=env,
+                variables=variables,
+                working_dir=working_dir,
+                output_view=output_view,
+                scope=scope,
+                stdin=stdin,
+            )
             self._kill_active_process()
             return
 
         if not command:
             raise ValueError("Empty command given")
 
-        if not any(
-            self.window.active_view().match_selector(cursor.begin(), scope)
-            for cursor in self.window.active_view().sel()
-        ):
+        if not scope_matches(self.window, scope):
             log(
                 "[execpp] Current scope does not match the job's scope configuration",
                 scope,
             )
             return
 
-        system_environment = os.environ.copy()
-        settings_environment = (
-            self.window.active_view().settings().get("build_env") or {}
-        )
-        sublime_build_system_variables = self.window.extract_variables()
-        process_environment = merge_and_substitute_environment_variables(
-            variables,
-            env,
-            sublime_build_system_variables,
-            settings_environment,
-            system_environment,
-        )
+        if self.output_view is None:
+            self.output_view = output_view_form(self.window, output_view)
+        self.output_view.show()
+
+        try:
+            start_build = prepare_build(
+                self.window, command, env, variables, working_dir, stdin
+            )
+            build_process = start_build(SublimeProcessListener(self.output_view))
+        except (OSError, ValueError) as error:
+            self.output_view.append(f"[execpp Unable to start the build: {error}]\n")
+            return
+
+        self.output_view.append(starting_message())
+        self.build_process = build_process
+        self.build_process.start()
+
+    def _kill_active_process(self) -> None:
+        if not self.build_process:
+            return
+
+        self.build_process.kill(cancellation_policy(), self._on_reaped)
+
+
+class ExecppMatrixCommand(CancellingWindowCommand):
+    def __init__(self, window: sublime.Window) -> None:
+        super().__init__(window)
+
+        self.matrix_run: Optional[MatrixRun] = None
+
+    def is_enabled(self, kill: bool = False, **kwargs: object) -> bool:
+        if kill:
+            return bool(self.matrix_run and self.matrix_run.is_active())
+        return True
+
+    def run(
+        self,
+        cells: List[Dict[str, Any]] = [],
+        max_parallel: int = 1,
+        output_view: str = "panel",
+        kill: bool = False,
+    ) -> None:
+        if kill and self.matrix_run and self.matrix_run.is_active():
+            log("[execpp] Killing active build matrix.")
+            self.pending_build = None
+            self.matrix_run.kill(cancellation_policy(), self._on_reaped)
+            return
+
+        if kill:
+            return
+
+        if self.matrix_run and self.matrix_run.is_active():
+            log("[execpp] Build matrix already on going. Canceling it before starting.")
+            self.pending_build = functools.partial(
+                self.run,
+                cells=cells,
+                max_parallel=max_parallel,
+                output_view=output_view,
+            )
+            self.matrix_run.kill(cancellation_policy(), self._on_reaped)
+            return
+
+        if not cells:
+            raise ValueError("Empty build matrix given")
 
-        process_command = [
-            expand_variable(command_part, process_environment)
-            for command_part in command
+        cells = [
+            cell for cell in cells if scope_matches(self.window, cell.get("scope", ""))
         ]
-        process_cwd = Path(expand_variable(working_dir, process_environment))
-        log("[execpp] Running", command, "from", process_cwd)
+        if not cells:
+            log("[execpp] Current scope does not match the scope of the build matrix")
+            return
 
         if self.output_view is None:
-            self.output_view = self._output_view_form(output_view)
+            self.output_view = output_view_form(self.window, output_view)
         self.output_view.show()
 
-        self.output_view.append(
-            f"[execpp Starting {datetime.datetime.now(tz=datetime.timezone.utc).isoformat()}]\n"
-        )
-        self.build_process = AsyncProcess(
-            process_command,
-            process_environment,
-            process_cwd,
+        self.output_view.append(starting_message())
+        view_text = ViewText(self.window.active_view())
+        self.matrix_run = MatrixRun(
+            [(cell["name"], self._prepare_cell(cell, view_text)) for cell in cells],
+            max_parallel,
             SublimeProcessListener(self.output_view),
         )
-        self.build_process.start()
+        self.matrix_run.start()
+
+    def _prepare_cell(
+        self, cell: Dict[str, Any], view_text: ViewText
+    ) -> Callable[[ProcessListener], AsyncProcess]:
+        try:
+            if not cell.get("command"):
+                raise ValueError("Empty command given")
+
+            return prepare_build(
+                self.window,
+                cell["command"],
+                cell.get("env", {}),
+                cell.get("variables", {}),
+                cell.get("working_dir", str(Path.cwd())),
+                cell.get("stdin", ""),
+                view_text,
+            )
+        except (OSError, ValueError) as error:
+            # Reported by the matrix run as the cell failing to start.
+            def fail(_: ProcessListener, error: Exception = error) -> AsyncProcess:
+                raise error
 
-    def _kill_active_process(self) -> None:
-        if not self.build_process:
+            return fail
+
+
+class ExecppJobserverStatusCommand(sublime_plugin.WindowCommand):
+    def run(self) -> None:
+        status_jobserver = jobserver()
+        if status_jobserver is None:
+            self.window.status_message("[execpp] Job server is disabled")
             return
 
-        self.build_process.kill()
+        self.window.status_message(
+            f"[execpp] {status_jobserver.builds()} builds and"
+            f" {status_jobserver.in_use()} job tokens in use"
+            f" of {status_jobserver.jobs} jobs"
+        )
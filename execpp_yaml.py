@@ -74,6 +74,25 @@ def find_and_load_configuration_files(window: sublime.Window) -> List[Build]:
     return all_variants
 
 
+def run_build(window: sublime.Window, build: Build) -> None:
+    cells = build.matrix()
+    if cells[0] is build:
+        window.run_command("execpp", args=asdict(build.config_for(build.name())))
+        return
+
+    window.run_command(
+        "execpp_matrix",
+        args={
+            "cells": [
+                dict(asdict(cell.config_for(cell.name())), name=cell.name())
+                for cell in cells
+            ],
+            "max_parallel": build.max_parallel(),
+            "output_view": build.config_for(build.name()).output_view,
+        },
+    )
+
+
 def on_build_select_with_choices(
     window: sublime.Window,
     choices: List[Build],
@@ -129,10 +148,7 @@ class RunLastExecppBuildCommand(sublime_plugin.WindowCommand):
             "with name",
             self.last_build_name,
         )
-        self.window.run_command(
-            "execpp",
-            args=asdict(self.saved_build_config.config_for(self.last_build_name)),
-        )
+        run_build(self.window, self.saved_build_config)
 
     def _select_build_if_missing(self) -> None:
         all_variants = find_and_load_configuration_files(self.window)
@@ -155,10 +171,7 @@ class RunLastExecppBuildCommand(sublime_plugin.WindowCommand):
                 "with name",
                 self.last_build_name,
             )
-            self.window.run_command(
-                "execpp",
-                args=asdict(self.saved_build_config.config_for(self.last_build_name)),
-            )
+            run_build(self.window, self.saved_build_config)
 
 
 class ListExecppBuildsCommand(sublime_plugin.WindowCommand):
@@ -166,9 +179,7 @@ class ListExecppBuildsCommand(sublime_plugin.WindowCommand):
         super().__init__(window)
 
     def _on_build_select(self, selected_build: Build) -> None:
-        self.window.run_command(
-            "execpp", args=asdict(selected_build.config_for(selected_build.name()))
-        )
+        run_build(self.window, selected_build)
 
     def run(self) -> None:
         all_variants = find_and_load_configuration_files(self.window)
@@ -1,15 +1,23 @@
+import array
 import codecs
 import dataclasses
 import os
+import shutil
 import signal
 import subprocess
+import tempfile
 import threading
 import time
 from pathlib import Path
 from typing import (
+    Callable,
     Dict,
+    Iterable,
+    Iterator,
     List,
     Optional,
+    Sequence,
+    Tuple,
 )
 
 
@@ -46,6 +54,46 @@ class CompletedProcessInfo:
     exit_code: int
 
 
+_ESCALATION = [signal.SIGINT, signal.SIGTERM, signal.SIGKILL]
+
+
+@dataclasses.dataclass(frozen=True)
+class CancellationPolicy:
+    """Grace periods, in seconds, given to a process group after each signal.
+
+    Cancelling sends SIGINT, then SIGTERM and finally SIGKILL, moving on to
+    the next signal when the group is still alive after the grace period.
+    """
+
+    interrupt_grace: float = 2.0
+    terminate_grace: float = 3.0
+    kill_grace: float = 5.0
+    poll_interval: float = 0.05
+
+
+@dataclasses.dataclass
+class CancellationInfo:
+    elapsed_seconds: float
+    # None when the process group was gone before any signal was sent.
+    last_signal: Optional[signal.Signals]
+    reaped: bool
+
+    def message(self) -> str:
+        if self.last_signal is None and self.reaped:
+            return "Cancelled after the process had already exited"
+        if self.last_signal is None:
+            return (
+                "Unable to signal the process group,"
+                f" gave up after {self.elapsed_seconds:0.2f}s"
+            )
+        if self.reaped:
+            return f"Cancelled with {self.last_signal.name} in {self.elapsed_seconds:0.2f}s"
+        return (
+            f"Process group survived {self.last_signal.name},"
+            f" gave up after {self.elapsed_seconds:0.2f}s"
+        )
+
+
 class OutputView:
     def append(self, text: str) -> None:
         pass
@@ -61,6 +109,265 @@ class ProcessListener:
     def on_finished(self, completed_process: CompletedProcessInfo) -> None:
         pass
 
+    def on_cancelled(self, cancellation: CancellationInfo) -> None:
+        pass
+
+
+STDIN_CHUNK_SIZE = 2**16
+
+
+def file_chunks(path: Path, chunk_size: int = STDIN_CHUNK_SIZE) -> Iterator[bytes]:
+    with path.open("rb") as file:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def text_chunks(
+    texts: Iterable[str],
+    separator: str = "\n",
+    chunk_size: int = STDIN_CHUNK_SIZE,
+) -> Iterator[bytes]:
+    """Encode ``texts`` joined by ``separator``, ``chunk_size`` characters at a time.
+
+    Only one chunk is encoded at a time, so the text is never held in memory
+    twice as a whole.
+    """
+    for index, text in enumerate(texts):
+        if index > 0 and separator:
+            yield separator.encode("utf-8")
+        for chunk_begin in range(0, len(text), chunk_size):
+            yield text[chunk_begin : chunk_begin + chunk_size].encode("utf-8")
+
+
+class JobServer:
+    """Token pool implementing the GNU make jobserver protocol over a fifo.
+
+    Children that inherit ``environment()`` share the pool, so concurrently
+    running builds share one CPU budget. As with make itself, every build owns
+    one implicit job slot. The first build's slot is why the pool holds
+    ``jobs - 1`` tokens, and every further build takes a token out of the pool
+    for its own slot until it finishes.
+    """
+
+    TOKEN = b"+"
+    DEBT_POLL_INTERVAL = 0.1
+
+    def __init__(self, jobs: int) -> None:
+        self.jobs = 0
+        self._tokens = 0
+        self._builds = 0
+        # Tokens removed from the budget while held by a child. They are
+        # swallowed as they are handed back instead of being put in the pool.
+        self._debt = 0
+        self._debt_collector: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._directory = Path(tempfile.mkdtemp(prefix="execpp-jobserver-"))
+        self.path = self._directory / "fifo"
+        os.mkfifo(self.path, 0o600)
+        # Keeping both ends open means tokens survive while no build runs.
+        self._fd: Optional[int] = os.open(self.path, os.O_RDWR | os.O_NONBLOCK)
+        # Children using the pipe style inherit a blocking descriptor, since
+        # O_NONBLOCK would be shared with them through the open file.
+        self._child_fd: Optional[int] = os.open(self.path, os.O_RDWR)
+        self.resize(jobs)
+
+    def environment(self, auth: str = "fifo", makeflags: str = "") -> Dict[str, str]:
+        """Return ``MAKEFLAGS`` pointing children at the pool.
+
+        The job server flags are appended to ``makeflags``, so they take
+        precedence over any job server settings already in there.
+
+        ``fifo`` is understood by GNU make 4.4 and later, ``pipe`` by older
+        versions but requires the children to inherit ``pass_fds(auth)``.
+        """
+        if auth == "fifo":
+            jobserver_auth = f"fifo:{self.path}"
+        elif auth == "pipe":
+            child_fd = self._child_file_descriptor()
+            jobserver_auth = f"{child_fd},{child_fd}"
+        else:
+            raise ValueError(f"Unknown jobserver auth style: {auth}")
+        jobserver_flags = f"-j{self.jobs} --jobserver-auth={jobserver_auth}"
+        return {"MAKEFLAGS": f"{makeflags} {jobserver_flags}".strip()}
+
+    def pass_fds(self, auth: str = "fifo") -> List[int]:
+        if auth == "pipe":
+            return [self._child_file_descriptor()]
+        return []
+
+    def resize(self, jobs: int) -> None:
+        if jobs < 1:
+            raise ValueError(f"A job server needs at least one job, got {jobs}")
+
+        with self._lock:
+            self.jobs = jobs
+            self._rebalance()
+
+    def build_started(self) -> None:
+        with self._lock:
+            # Builds may outlive the job server, e.g. when the plugin reloads.
+            if self._fd is None:
+                return
+            self._builds += 1
+            self._rebalance()
+
+    def build_finished(self) -> None:
+        with self._lock:
+            if self._fd is None:
+                return
+            self._builds = max(0, self._builds - 1)
+            if self._builds == 0:
+                self._refill()
+            else:
+                self._rebalance()
+
+    def tokens(self) -> int:
+        return self._tokens
+
+    def builds(self) -> int:
+        return self._builds
+
+    def available(self) -> int:
+        with self._lock:
+            self._settle_debt()
+            return self._available()
+
+    def in_use(self) -> int:
+        """Number of tokens currently held by running children."""
+        with self._lock:
+            self._settle_debt()
+            return self._tokens + self._debt - self._available()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._fd is None:
+                return
+            os.close(self._fd)
+            self._fd = None
+            if self._child_fd is not None:
+                os.close(self._child_fd)
+                self._child_fd = None
+            shutil.rmtree(self._directory, ignore_errors=True)
+
+    def _file_descriptor(self) -> int:
+        if self._fd is None:
+            raise ValueError("The job server is closed")
+        return self._fd
+
+    def _child_file_descriptor(self) -> int:
+        if self._child_fd is None:
+            raise ValueError("The job server is closed")
+        return self._child_fd
+
+    def _available(self) -> int:
+        # Imported here since these modules only exist on Unix.
+        import fcntl  # pylint: disable=import-outside-toplevel
+        import termios  # pylint: disable=import-outside-toplevel
+
+        buffer = array.array("i", [0])
+        fcntl.ioctl(self._file_descriptor(), termios.FIONREAD, buffer, True)
+        return buffer[0]
+
+    def _write_tokens(self, count: int) -> None:
+        if count > 0:
+            os.write(self._file_descriptor(), self.TOKEN * count)
+
+    def _rebalance(self) -> None:
+        """Resize the pool so that it and the builds' slots add up to ``jobs``."""
+        self._settle_debt()
+        tokens = max(0, self.jobs - max(1, self._builds))
+        if tokens > self._tokens:
+            returned_debt = min(self._debt, tokens - self._tokens)
+            self._debt -= returned_debt
+            self._write_tokens(tokens - self._tokens - returned_debt)
+        else:
+            self._debt += self._tokens - tokens
+        self._tokens = tokens
+        self._settle_debt()
+
+    def _refill(self) -> None:
+        """Reset the pool once no build runs, so every token is back.
+
+        Tokens held by children that were killed are never handed back, and
+        would otherwise shrink the pool for good.
+        """
+        self._tokens = self.jobs - 1
+        self._debt = 0
+        available = self._available()
+        if available < self._tokens:
+            self._write_tokens(self._tokens - available)
+        elif available > self._tokens:
+            os.read(self._file_descriptor(), available - self._tokens)
+
+    def _settle_debt(self) -> None:
+        swallowed = min(self._debt, self._available())
+        if swallowed > 0:
+            self._debt -= len(os.read(self._file_descriptor(), swallowed))
+        if self._debt > 0 and self._debt_collector is None:
+            self._debt_collector = threading.Thread(
+                target=self._collect_debt, daemon=True
+            )
+            self._debt_collector.start()
+
+    def _collect_debt(self) -> None:
+        """Swallow tokens as soon as children hand them back, while any are owed.
+
+        Without this, returned tokens would be picked up again by other
+        children and the pool would only shrink on the next build start or
+        finish.
+        """
+        # Imported here since select.select on pipes only works on Unix.
+        import select  # pylint: disable=import-outside-toplevel
+
+        while True:
+            with self._lock:
+                if self._fd is None or self._debt == 0:
+                    self._debt_collector = None
+                    return
+                self._settle_debt()
+                fd = self._fd
+            try:
+                select.select([fd], [], [], self.DEBT_POLL_INTERVAL)
+            except (OSError, ValueError):
+                # The job server was closed while waiting.
+                pass
+
+
+_shared_jobserver: Optional[JobServer] = None
+_shared_jobserver_lock = threading.Lock()
+
+
+def shared_jobserver(jobs: Optional[int] = None) -> Optional[JobServer]:
+    """Return the job server shared by all builds, sized to ``jobs``.
+
+    ``jobs`` defaults to the number of CPUs. Zero disables the job server, and
+    so do platforms without named pipes.
+    """
+    global _shared_jobserver  # pylint: disable=global-statement
+
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+
+    with _shared_jobserver_lock:
+        if jobs < 1 or not hasattr(os, "mkfifo"):
+            if _shared_jobserver is not None:
+                _shared_jobserver.close()
+                _shared_jobserver = None
+            return None
+
+        if _shared_jobserver is None:
+            _shared_jobserver = JobServer(jobs)
+        elif _shared_jobserver.jobs != jobs:
+            _shared_jobserver.resize(jobs)
+        return _shared_jobserver
+
+
+def close_shared_jobserver() -> None:
+    shared_jobserver(0)
+
 
 class AsyncProcess:
     def __init__(
@@ -69,12 +376,39 @@ class AsyncProcess:
         process_environment: Dict[str, str],
         cwd: Path,
         listener: ProcessListener,
+        pass_fds: Sequence[int] = (),
+        stdin: Optional[Iterable[bytes]] = None,
+        jobserver: Optional[JobServer] = None,
     ) -> None:
         self.listener = listener
         self.start_time = Timestamp.now()
         self.killed = False
+        self.jobserver = jobserver
+
+        if self.jobserver is not None:
+            self.jobserver.build_started()
+        try:
+            self.process = self._popen(cmd, process_environment, cwd, pass_fds)
+        except Exception:
+            self._release_jobserver()
+            raise
+
+        self.stdout_thread = threading.Thread(target=self.read_output)
+        self.stdin_thread = threading.Thread(
+            target=self.write_input, args=(stdin or [],)
+        )
+        self.cancel_thread: Optional[threading.Thread] = None
+        self._cancellation_reported = threading.Event()
+        self._cancellation_finished = threading.Event()
 
-        self.process = subprocess.Popen(  # pylint: disable=consider-using-with
+    @staticmethod
+    def _popen(
+        cmd: List[str],
+        process_environment: Dict[str, str],
+        cwd: Path,
+        pass_fds: Sequence[int],
+    ) -> "subprocess.Popen[bytes]":
+        return subprocess.Popen(  # pylint: disable=consider-using-with
             cmd,
             bufsize=0,
             stdout=subprocess.PIPE,
@@ -84,22 +418,40 @@ class AsyncProcess:
             cwd=cwd,
             shell=False,
             start_new_session=True,
+            pass_fds=pass_fds,
         )
 
-        self.stdout_thread = threading.Thread(target=self.read_output)
+    def _release_jobserver(self) -> None:
+        jobserver, self.jobserver = self.jobserver, None
+        if jobserver is not None:
+            jobserver.build_finished()
 
     def start(self) -> None:
+        self.stdin_thread.start()
         self.stdout_thread.start()
 
-    def kill(self) -> None:
+    def kill(
+        self,
+        policy: CancellationPolicy = CancellationPolicy(),
+        on_reaped: Optional[Callable[[CancellationInfo], None]] = None,
+    ) -> None:
+        """Cancel the whole process group without blocking the caller.
+
+        ``on_reaped`` is called from the cancelling thread once no process of
+        the group is left, or once even SIGKILL did not get rid of them.
+        """
         if self.killed:
             return
 
         self.killed = True
-        os.killpg(self.process.pid, signal.SIGTERM)
-        self.process.terminate()
+        self.cancel_thread = threading.Thread(
+            target=self._cancel, args=(policy, on_reaped)
+        )
+        self.cancel_thread.start()
 
     def is_active(self) -> bool:
+        if self.killed:
+            return not self._cancellation_finished.is_set()
         return self.exit_code() is None
 
     def exit_code(self) -> Optional[int]:
@@ -117,12 +469,310 @@ class AsyncProcess:
             Timespan(self.start_time, Timestamp.now()), exit_code
         )
 
+    def _cancel(
+        self,
+        policy: CancellationPolicy,
+        on_reaped: Optional[Callable[[CancellationInfo], None]],
+    ) -> None:
+        start = time.monotonic()
+        cancellation = CancellationInfo(0.0, None, False)
+        try:
+            self._escalate(policy, cancellation)
+        finally:
+            # Whatever happens, the reader and on_reaped must hear about it,
+            # or the build would count as active forever.
+            cancellation.elapsed_seconds = time.monotonic() - start
+            cancellation.reaped = not self._group_alive()
+            self._finish_cancellation(policy, cancellation, on_reaped)
+
+    def _escalate(
+        self, policy: CancellationPolicy, cancellation: CancellationInfo
+    ) -> None:
+        graces = [policy.interrupt_grace, policy.terminate_grace, policy.kill_grace]
+        for cancel_signal, grace in zip(_ESCALATION, graces):
+            try:
+                os.killpg(self.process.pid, cancel_signal)
+            except ProcessLookupError:
+                return
+            except PermissionError:
+                # E.g. a setuid child leads the group; it cannot be signalled.
+                return
+            cancellation.last_signal = cancel_signal
+            if self._wait_for_group(grace, policy.poll_interval):
+                return
+
+    def _finish_cancellation(
+        self,
+        policy: CancellationPolicy,
+        cancellation: CancellationInfo,
+        on_reaped: Optional[Callable[[CancellationInfo], None]],
+    ) -> None:
+        try:
+            self.listener.on_cancelled(cancellation)
+        finally:
+            # The reader waits for this to report the cancellation first.
+            self._cancellation_reported.set()
+            if self.stdout_thread.ident is not None:
+                self.stdout_thread.join(policy.kill_grace)
+            # Marked before on_reaped, which may start a new build right away.
+            self._cancellation_finished.set()
+            if on_reaped is not None:
+                on_reaped(cancellation)
+
+    def _wait_for_group(self, timeout: float, poll_interval: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while self._group_alive():
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(poll_interval)
+        return True
+
+    def _group_alive(self) -> bool:
+        # The group leader stays a zombie, and thereby in the group, until it
+        # is waited for.
+        self.process.poll()
+        try:
+            os.killpg(self.process.pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    def write_input(self, chunks: Iterable[bytes]) -> None:
+        """Feed ``chunks`` to the child and close its stdin afterwards.
+
+        Writes block while the pipe is full, so the child sets the pace and
+        chunks are only produced once there is room for them.
+        """
+        stdin = self.process.stdin
+        if stdin is None:
+            return
+
+        try:
+            for chunk in chunks:
+                if self.killed:
+                    break
+                view = memoryview(chunk)
+                while view:
+                    view = view[stdin.write(view) :]
+        except BrokenPipeError:
+            # The child exited or closed stdin without reading everything.
+            pass
+        except OSError as error:
+            self.listener.on_data(f"[Unable to write stdin: {error}]\n")
+        finally:
+            try:
+                stdin.close()
+            except BrokenPipeError:
+                pass
+
     def read_output(self) -> None:
         decoder = codecs.getincrementaldecoder("utf-8")("replace")
         while self.process.stdout:
-            data = decoder.decode(self.process.stdout.read(2**16))
+            raw_data = self.process.stdout.read(2**16)
+            if not raw_data:
+                if self.killed:
+                    self._cancellation_reported.wait()
+                completed_process = self._clean_process()
+                self._release_jobserver()
+                self.listener.on_finished(completed_process)
+                break
+
+            # Output is still drained while cancelling, so that children
+            # shutting down never block on a full pipe.
+            data = decoder.decode(raw_data)
             if data and not self.killed:
                 self.listener.on_data(data)
+
+
+@dataclasses.dataclass
+class MatrixCellResult:
+    name: str
+    status: str
+    exit_code: Optional[int] = None
+    elapsed_seconds: Optional[float] = None
+
+
+def format_matrix_summary(results: List[MatrixCellResult]) -> str:
+    rows = [("Cell", "Status", "Exit code", "Duration")] + [
+        (
+            result.name,
+            result.status,
+            "" if result.exit_code is None else str(result.exit_code),
+            (
+                ""
+                if result.elapsed_seconds is None
+                else f"{result.elapsed_seconds:0.2f}s"
+            ),
+        )
+        for result in results
+    ]
+    widths = [max(len(row[column]) for row in rows) for column in range(4)]
+    return "".join(
+        f"{name:<{widths[0]}}  {status:<{widths[1]}}  "
+        f"{exit_code:>{widths[2]}}  {duration:>{widths[3]}}".rstrip() + "\n"
+        for name, status, exit_code, duration in rows
+    )
+
+
+class _MatrixCellListener(ProcessListener):
+    """Prefixes every line of a cell's output with the cell's name."""
+
+    def __init__(self, run: "MatrixRun", index: int) -> None:
+        self.run = run
+        self.index = index
+        self.prefix = f"[{run.results[index].name}] "
+        self.partial_line = ""
+
+    def on_data(self, text: str) -> None:
+        lines = (self.partial_line + text).split("\n")
+        self.partial_line = lines.pop()
+        if lines:
+            self.run.listener.on_data(
+                "".join(f"{self.prefix}{line}\n" for line in lines)
+            )
+
+    def on_finished(self, completed_process: CompletedProcessInfo) -> None:
+        if self.partial_line:
+            self.run.listener.on_data(f"{self.prefix}{self.partial_line}\n")
+        self.run.on_cell_finished(self.index, completed_process)
+
+    def on_cancelled(self, cancellation: CancellationInfo) -> None:
+        self.run.listener.on_data(f"{self.prefix}[{cancellation.message()}]\n")
+
+
+class MatrixRun:
+    """Runs the cells of a build matrix, at most ``max_parallel`` at a time.
+
+    ``cells`` pairs each cell's name with a function starting its process
+    for a given listener. Output of all cells goes to ``listener``, followed
+    by a summary table once every cell is done.
+    """
+
+    def __init__(
+        self,
+        cells: List[Tuple[str, Callable[[ProcessListener], AsyncProcess]]],
+        max_parallel: int,
+        listener: ProcessListener,
+    ) -> None:
+        self.listener = listener
+        self.max_parallel = max(1, max_parallel)
+        self.start_time = Timestamp.now()
+        self.killed = False
+        self.results = [MatrixCellResult(name, "pending") for name, _ in cells]
+        self.processes: Dict[int, AsyncProcess] = {}
+        self._starters = [start for _, start in cells]
+        self._pending = list(range(len(cells)))
+        self._cell_start_times: Dict[int, float] = {}
+        self._cancelling = 0
+        self._cancellations: List[CancellationInfo] = []
+        self._on_reaped: Optional[Callable[[CancellationInfo], None]] = None
+        self._kill_start_time = 0.0
+        self._reported = False
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        with self._lock:
+            self._start_pending()
+        self._finish_if_done()
+
+    def kill(
+        self,
+        policy: CancellationPolicy = CancellationPolicy(),
+        on_reaped: Optional[Callable[[CancellationInfo], None]] = None,
+    ) -> None:
+        """Cancel every running cell and drop the pending ones.
+
+        ``on_reaped`` is called once the process groups of all running cells
+        are reaped, with the slowest shutdown and the strongest signal needed.
+        """
+        with self._lock:
+            if self.killed:
+                return
+            self.killed = True
+            for index in self._pending:
+                self.results[index].status = "cancelled"
+            self._pending = []
+            running = list(self.processes.values())
+            self._cancelling = len(running)
+            self._on_reaped = on_reaped
+            self._kill_start_time = time.monotonic()
+
+        if not running and on_reaped is not None:
+            on_reaped(CancellationInfo(0.0, None, True))
+        for process in running:
+            process.kill(policy, self._on_cell_reaped)
+        self._finish_if_done()
+
+    def is_active(self) -> bool:
+        with self._lock:
+            if self.killed:
+                return self._cancelling > 0
+            return bool(self._pending or self.processes)
+
+    def _on_cell_reaped(self, cancellation: CancellationInfo) -> None:
+        with self._lock:
+            self._cancellations.append(cancellation)
+            self._cancelling -= 1
+            if self._cancelling > 0 or self._on_reaped is None:
+                return
+            on_reaped = self._on_reaped
+            signals = [
+                cell.last_signal
+                for cell in self._cancellations
+                if cell.last_signal is not None
+            ]
+            matrix_cancellation = CancellationInfo(
+                time.monotonic() - self._kill_start_time,
+                max(signals, key=_ESCALATION.index) if signals else None,
+                all(cell.reaped for cell in self._cancellations),
+            )
+        on_reaped(matrix_cancellation)
+
+    def on_cell_finished(
+        self, index: int, completed_process: CompletedProcessInfo
+    ) -> None:
+        with self._lock:
+            result = self.results[index]
+            self.processes.pop(index, None)
+            result.exit_code = completed_process.exit_code
+            result.elapsed_seconds = time.monotonic() - self._cell_start_times[index]
+            if self.killed:
+                result.status = "killed"
             else:
-                self.listener.on_finished(self._clean_process())
-                break
+                result.status = "passed" if result.exit_code == 0 else "failed"
+            self._start_pending()
+        self._finish_if_done()
+
+    def _start_pending(self) -> None:
+        while self._pending and len(self.processes) < self.max_parallel:
+            index = self._pending.pop(0)
+            self._cell_start_times[index] = time.monotonic()
+            try:
+                process = self._starters[index](_MatrixCellListener(self, index))
+            except (OSError, ValueError) as error:
+                self.listener.on_data(f"[{self.results[index].name}] {error}\n")
+                self.results[index].status = "error"
+                self.results[index].elapsed_seconds = (
+                    time.monotonic() - self._cell_start_times[index]
+                )
+                continue
+            self.results[index].status = "running"
+            self.processes[index] = process
+            process.start()
+
+    def _finish_if_done(self) -> None:
+        with self._lock:
+            # Only the first caller to see the run as done reports it.
+            if self._pending or self.processes or self._reported:
+                return
+            self._reported = True
+
+        self.listener.on_data(format_matrix_summary(self.results))
+        failed = any(result.status != "passed" for result in self.results)
+        self.listener.on_finished(
+            CompletedProcessInfo(
+                Timespan(self.start_time, Timestamp.now()), int(failed)
+            )
+        )
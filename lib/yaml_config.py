@@ -1,3 +1,5 @@
+import itertools
+import os
 from collections import ChainMap
 from dataclasses import dataclass, field
 from pathlib import Path
@@ -5,6 +7,7 @@ from typing import (
     Any,
     Dict,
     List,
+    Mapping,
     MutableMapping,
 )
 
@@ -25,6 +28,7 @@ class ExecppYamlBuild:
     output_view: str = "panel"
     scope: str = ""
     kill: bool = False
+    stdin: str = ""
 
 
 class Build:
@@ -48,6 +52,54 @@ class Build:
             for variant in self.loaded_config.get("variants", [])
         ]
 
+    def matrix(self) -> List["Build"]:
+        """Expand the ``matrix`` key into one build per combination of values.
+
+        Every cell gets the values of its combination as ``variables``, on top
+        of the variables the build already defines.
+        """
+        axes = self.loaded_config.get("matrix") or {}
+        if not axes:
+            return [self]
+        if not isinstance(axes, Mapping):
+            raise ValueError(
+                f"The matrix of {self.name()} must map variable names to values"
+            )
+
+        axis_values = [_matrix_axis_values(values) for values in axes.values()]
+        for axis_name, values_of_axis in zip(axes, axis_values):
+            if not values_of_axis:
+                raise ValueError(f"The matrix variable {axis_name} has no values")
+
+        axis_names = list(axes)
+        cells = []
+        for values in itertools.product(*axis_values):
+            cell_variables = {
+                name: str(value) for name, value in zip(axis_names, values)
+            }
+            cell_name = ", ".join(
+                f"{name}={value}" for name, value in cell_variables.items()
+            )
+            cells.append(
+                Build(
+                    ChainMap(
+                        {
+                            "name": f"{self.name()} [{cell_name}]",
+                            "matrix": {},
+                            "variables": {
+                                **self.loaded_config.get("variables", {}),
+                                **cell_variables,
+                            },
+                        },
+                        self.loaded_config,
+                    )
+                )
+            )
+        return cells
+
+    def max_parallel(self) -> int:
+        return int(self.loaded_config.get("max_parallel") or os.cpu_count() or 1)
+
     def _find_variant(self, name: str) -> "Build":
         if name == self.name():
             return self
@@ -70,12 +122,19 @@ class Build:
             output_view=build.loaded_config.get("output_view", "panel"),
             scope=build.loaded_config.get("scope", ""),
             kill=build.loaded_config.get("kill", False),
+            stdin=build.loaded_config.get("stdin", ""),
         )
 
     def scope(self) -> str:
         return self.loaded_config.get("scope", "")
 
 
+def _matrix_axis_values(values: Any) -> List[Any]:
+    if isinstance(values, list):
+        return values
+    return [values]
+
+
 def load_resource(yaml_content: str) -> MutableMapping[str, Any]:
     # Ignore this until the value in the file can be assigned types.
     return yaml.safe_load(yaml_content)  # type: ignore
@@ -1,6 +1,12 @@
 import asyncio
+import contextlib
+import os
+import signal
+import threading
+import time
 from pathlib import Path
 from typing import (
+    Callable,
     List,
     Optional,
 )
@@ -36,3 +42,384 @@ async def test_basic_async_process() -> None:
     await wait_for(p)
 
     assert "hi" == listener.text()
+
+
+def test_jobserver_pool_holds_one_token_less_than_jobs() -> None:
+    jobserver = process.JobServer(4)
+    try:
+        assert 3 == jobserver.available()
+        assert 0 == jobserver.in_use()
+        assert str(jobserver.path) in jobserver.environment()["MAKEFLAGS"]
+    finally:
+        jobserver.close()
+
+
+def test_jobserver_shrinking_waits_for_tokens_in_use() -> None:
+    jobserver = process.JobServer(4)
+    try:
+        with open(jobserver.path, "rb", buffering=0) as fifo:
+            token = fifo.read(2)
+            assert 2 == jobserver.in_use()
+
+            jobserver.resize(2)
+            assert 0 == jobserver.available()
+            assert 2 == jobserver.in_use()
+
+            with open(jobserver.path, "wb", buffering=0) as fifo_writer:
+                fifo_writer.write(token)
+            assert 1 == jobserver.available()
+            assert 0 == jobserver.in_use()
+    finally:
+        jobserver.close()
+
+
+def run_to_completion(p: process.AsyncProcess) -> None:
+    p.start()
+    p.stdin_thread.join()
+    p.stdout_thread.join()
+
+
+def test_stdin_is_streamed_and_closed() -> None:
+    listener = FakeListener()
+    chunks = [b"hello ", b"world"]
+    p = process.AsyncProcess(["cat"], {}, Path.cwd(), listener, stdin=chunks)
+    run_to_completion(p)
+
+    assert "hello world" == "".join(listener.lines)
+    assert listener.process_info and 0 == listener.process_info.exit_code
+
+
+def test_stdin_without_input_does_not_hang() -> None:
+    listener = FakeListener()
+    p = process.AsyncProcess(["cat"], {}, Path.cwd(), listener)
+    run_to_completion(p)
+
+    assert "" == listener.text()
+
+
+def test_stdin_larger_than_pipe_buffer(tmp_path: Path) -> None:
+    stdin_file = tmp_path / "input"
+    stdin_file.write_bytes(b"x" * 2**20)
+    listener = FakeListener()
+    p = process.AsyncProcess(
+        ["wc", "-c"], {}, Path.cwd(), listener, stdin=process.file_chunks(stdin_file)
+    )
+    run_to_completion(p)
+
+    assert str(2**20) == listener.text()
+
+
+def test_text_chunks_joins_texts() -> None:
+    chunks = list(process.text_chunks(["first", "third"], chunk_size=2))
+    assert b"first\nthird" == b"".join(chunks)
+    assert all(len(chunk) <= 2 for chunk in chunks)
+
+
+class FinishedListener(FakeListener):
+    def __init__(self) -> None:
+        super().__init__()
+        self.finished = threading.Event()
+
+    def on_finished(self, completed_process: process.CompletedProcessInfo) -> None:
+        super().on_finished(completed_process)
+        self.finished.set()
+
+
+def test_matrix_run_limits_parallelism_and_summarizes() -> None:
+    listener = FinishedListener()
+    most_running = 0
+
+    def cell(
+        exit_code: int,
+    ) -> Callable[[process.ProcessListener], process.AsyncProcess]:
+        def start(cell_listener: process.ProcessListener) -> process.AsyncProcess:
+            nonlocal most_running
+            most_running = max(most_running, len(matrix.processes) + 1)
+            return process.AsyncProcess(
+                ["sh", "-c", f"echo cell; exit {exit_code}"],
+                {},
+                Path.cwd(),
+                cell_listener,
+            )
+
+        return start
+
+    matrix = process.MatrixRun(
+        [("a", cell(0)), ("b", cell(1)), ("c", cell(0))], 2, listener
+    )
+    matrix.start()
+    assert listener.finished.wait(10)
+
+    assert 2 == most_running
+    assert ["passed", "failed", "passed"] == [r.status for r in matrix.results]
+    assert listener.process_info and 1 == listener.process_info.exit_code
+    output = "".join(listener.lines)
+    assert "[b] cell\n" in output
+    assert output.splitlines()[-4].startswith("Cell")
+    assert all(
+        result.elapsed_seconds is not None and 0 < result.elapsed_seconds < 10
+        for result in matrix.results
+    )
+
+
+class CancellationListener(FinishedListener):
+    def __init__(self) -> None:
+        super().__init__()
+        self.cancellation: Optional[process.CancellationInfo] = None
+
+    def on_cancelled(self, cancellation: process.CancellationInfo) -> None:
+        assert not self.finished.is_set()
+        self.cancellation = cancellation
+
+
+FAST_CANCELLATION = process.CancellationPolicy(
+    interrupt_grace=0.2, terminate_grace=0.2, kill_grace=2.0, poll_interval=0.01
+)
+
+
+def test_kill_stops_at_interrupt_when_it_suffices() -> None:
+    listener = CancellationListener()
+    p = process.AsyncProcess(["sleep", "30"], {}, Path.cwd(), listener)
+    p.start()
+    reaped = threading.Event()
+    p.kill(FAST_CANCELLATION, lambda _: reaped.set())
+    assert reaped.wait(5)
+
+    assert listener.cancellation and listener.cancellation.reaped
+    assert signal.SIGINT == listener.cancellation.last_signal
+    assert listener.finished.is_set()
+    assert not p.is_active()
+
+
+def test_kill_escalates_and_reaps_the_whole_group() -> None:
+    listener = CancellationListener()
+    p = process.AsyncProcess(
+        ["sh", "-c", "trap '' INT TERM; sleep 30 & sleep 30; wait"],
+        {},
+        Path.cwd(),
+        listener,
+    )
+    p.start()
+    time.sleep(0.1)
+    reaped = threading.Event()
+    p.kill(FAST_CANCELLATION, lambda _: reaped.set())
+    assert p.is_active()
+    assert reaped.wait(5)
+
+    assert listener.cancellation and listener.cancellation.reaped
+    assert signal.SIGKILL == listener.cancellation.last_signal
+    assert listener.cancellation.elapsed_seconds >= 0.4
+    with pytest.raises(ProcessLookupError):
+        os.killpg(p.process.pid, 0)
+
+
+def test_jobserver_flags_are_appended_to_existing_makeflags() -> None:
+    jobserver = process.JobServer(2)
+    try:
+        makeflags = jobserver.environment(makeflags="-k")["MAKEFLAGS"]
+        assert makeflags.startswith("-k -j2 --jobserver-auth=fifo:")
+    finally:
+        jobserver.close()
+
+
+def test_jobserver_takes_a_token_for_every_further_build() -> None:
+    jobserver = process.JobServer(4)
+    try:
+        jobserver.build_started()
+        assert 3 == jobserver.available()
+        jobserver.build_started()
+        jobserver.build_started()
+        assert 1 == jobserver.available()
+
+        jobserver.build_finished()
+        assert 2 == jobserver.available()
+    finally:
+        jobserver.close()
+
+
+def test_jobserver_refills_tokens_lost_by_killed_builds() -> None:
+    jobserver = process.JobServer(4)
+    try:
+        jobserver.build_started()
+        with open(jobserver.path, "rb", buffering=0) as fifo:
+            # The child holding these is killed and never hands them back.
+            fifo.read(2)
+        assert 2 == jobserver.in_use()
+
+        jobserver.build_finished()
+        assert 3 == jobserver.available()
+        assert 0 == jobserver.in_use()
+    finally:
+        jobserver.close()
+
+
+def test_async_process_releases_its_jobserver_slot() -> None:
+    jobserver = process.JobServer(2)
+    try:
+        listener = FakeListener()
+        p = process.AsyncProcess(
+            ["true"], {}, Path.cwd(), listener, jobserver=jobserver
+        )
+        assert 1 == jobserver.builds()
+        run_to_completion(p)
+        assert 0 == jobserver.builds()
+    finally:
+        jobserver.close()
+
+
+def test_process_is_inactive_once_on_reaped_runs() -> None:
+    p = process.AsyncProcess(["sleep", "30"], {}, Path.cwd(), FakeListener())
+    p.start()
+    active_when_reaped: List[bool] = []
+    reaped = threading.Event()
+
+    def on_reaped(_: process.CancellationInfo) -> None:
+        active_when_reaped.append(p.is_active())
+        reaped.set()
+
+    p.kill(FAST_CANCELLATION, on_reaped)
+    assert reaped.wait(5)
+    assert [False] == active_when_reaped
+
+
+def test_kill_after_exit_sends_no_signal() -> None:
+    p = process.AsyncProcess(["true"], {}, Path.cwd(), FakeListener())
+    run_to_completion(p)
+    cancellations: List[process.CancellationInfo] = []
+    reaped = threading.Event()
+
+    def on_reaped(cancellation: process.CancellationInfo) -> None:
+        cancellations.append(cancellation)
+        reaped.set()
+
+    p.kill(FAST_CANCELLATION, on_reaped)
+    assert reaped.wait(5)
+
+    assert cancellations[0].last_signal is None
+    assert "already exited" in cancellations[0].message()
+
+
+class BrokenCancellationListener(FinishedListener):
+    def on_cancelled(self, cancellation: process.CancellationInfo) -> None:
+        raise RuntimeError("The output view is gone")
+
+
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+def test_failing_cancellation_report_still_finishes() -> None:
+    listener = BrokenCancellationListener()
+    p = process.AsyncProcess(["sleep", "30"], {}, Path.cwd(), listener)
+    p.start()
+    p.kill(FAST_CANCELLATION)
+    assert listener.finished.wait(5)
+
+
+def test_jobserver_swallows_owed_tokens_as_soon_as_they_return() -> None:
+    jobserver = process.JobServer(4)
+    try:
+        jobserver.build_started()
+        with open(jobserver.path, "rb", buffering=0) as fifo:
+            tokens = fifo.read(3)
+            # The second build's slot is owed by the children holding tokens.
+            jobserver.build_started()
+
+            with open(jobserver.path, "wb", buffering=0) as fifo_writer:
+                fifo_writer.write(tokens[:1])
+            time.sleep(0.5)
+
+            reader = os.open(jobserver.path, os.O_RDONLY | os.O_NONBLOCK)
+            try:
+                with pytest.raises(BlockingIOError):
+                    os.read(reader, 1)
+            finally:
+                os.close(reader)
+    finally:
+        jobserver.close()
+
+
+def test_builds_outliving_a_closed_jobserver_still_finish() -> None:
+    jobserver = process.JobServer(2)
+    listener = FinishedListener()
+    p = process.AsyncProcess(
+        ["sleep", "0.2"], {}, Path.cwd(), listener, jobserver=jobserver
+    )
+    p.start()
+    jobserver.close()
+    assert listener.finished.wait(5)
+
+
+def test_cancellation_finishes_when_the_group_cannot_be_signalled(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    p = process.AsyncProcess(["sleep", "30"], {}, Path.cwd(), FakeListener())
+    p.start()
+    killpg = os.killpg
+
+    def refuse_signals(pgid: int, sig: int) -> None:
+        if sig != 0:
+            raise PermissionError("Operation not permitted")
+        killpg(pgid, sig)
+
+    monkeypatch.setattr(os, "killpg", refuse_signals)
+    cancellations: List[process.CancellationInfo] = []
+    reaped = threading.Event()
+
+    def on_reaped(cancellation: process.CancellationInfo) -> None:
+        cancellations.append(cancellation)
+        reaped.set()
+
+    p.kill(process.CancellationPolicy(kill_grace=0.1, poll_interval=0.01), on_reaped)
+    try:
+        assert reaped.wait(5)
+        assert not p.is_active()
+        assert not cancellations[0].reaped
+        assert "Unable to signal" in cancellations[0].message()
+    finally:
+        monkeypatch.undo()
+        with contextlib.suppress(ProcessLookupError):
+            os.killpg(p.process.pid, signal.SIGKILL)
+
+
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+def test_broken_policy_still_finishes_the_cancellation() -> None:
+    listener = FinishedListener()
+    p = process.AsyncProcess(["sleep", "30"], {}, Path.cwd(), listener)
+    p.start()
+    reaped = threading.Event()
+    broken_policy = process.CancellationPolicy(
+        interrupt_grace="2", kill_grace=0.1  # type: ignore
+    )
+    p.kill(broken_policy, lambda _: reaped.set())
+    try:
+        assert reaped.wait(5)
+        assert not p.is_active()
+    finally:
+        with contextlib.suppress(ProcessLookupError):
+            os.killpg(p.process.pid, signal.SIGKILL)
+    assert listener.finished.wait(5)
+
+
+def test_matrix_kill_reports_once_every_cell_is_reaped() -> None:
+    listener = FinishedListener()
+
+    def start(cell_listener: process.ProcessListener) -> process.AsyncProcess:
+        return process.AsyncProcess(["sleep", "30"], {}, Path.cwd(), cell_listener)
+
+    matrix = process.MatrixRun([("a", start), ("b", start), ("c", start)], 2, listener)
+    matrix.start()
+    cancellations: List[process.CancellationInfo] = []
+    active_when_reaped: List[bool] = []
+    reaped = threading.Event()
+
+    def on_reaped(cancellation: process.CancellationInfo) -> None:
+        cancellations.append(cancellation)
+        active_when_reaped.append(matrix.is_active())
+        reaped.set()
+
+    matrix.kill(FAST_CANCELLATION, on_reaped)
+    assert reaped.wait(5)
+
+    assert [False] == active_when_reaped
+    assert cancellations[0].reaped
+    assert signal.SIGINT == cancellations[0].last_signal
+    assert ["killed", "killed", "cancelled"] == [r.status for r in matrix.results]
+    assert listener.finished.wait(5)
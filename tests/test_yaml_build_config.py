@@ -46,3 +46,91 @@ def test_output_view_can_be_changed() -> None:
     )
     build = Build(load_resource(config))
     assert "tab" == build.config_for("simple test").output_view
+
+
+def test_stdin_defaults_to_no_input() -> None:
+    config = dedent(
+        """
+        name: simple test
+        command:
+            - cat
+        variants:
+            - name: from buffer
+              stdin: buffer
+    """
+    )
+    build = Build(load_resource(config))
+    assert "" == build.config_for("simple test").stdin
+    assert "buffer" == build.config_for("from buffer").stdin
+
+
+def test_matrix_expands_into_cartesian_product_of_variables() -> None:
+    config = dedent(
+        """
+        name: tests
+        variables:
+            runner: pytest
+            python: "3.8"
+        matrix:
+            python: ["3.8", "3.12"]
+            mode: [debug, release]
+        command:
+            - python${python}
+    """
+    )
+    cells = Build(load_resource(config)).matrix()
+
+    assert [
+        "tests [python=3.8, mode=debug]",
+        "tests [python=3.8, mode=release]",
+        "tests [python=3.12, mode=debug]",
+        "tests [python=3.12, mode=release]",
+    ] == [cell.name() for cell in cells]
+    assert {"runner": "pytest", "python": "3.12", "mode": "release"} == cells[
+        -1
+    ].config_for(cells[-1].name()).variables
+
+
+def test_build_without_matrix_is_its_own_cell() -> None:
+    build = Build(load_resource("name: simple test"))
+    assert [build] == build.matrix()
+
+
+def test_matrix_scalar_axis_is_a_single_value() -> None:
+    config = dedent(
+        """
+        name: tests
+        matrix:
+            python: "3.10"
+            mode: [debug, release]
+    """
+    )
+    cells = Build(load_resource(config)).matrix()
+    assert [
+        "tests [python=3.10, mode=debug]",
+        "tests [python=3.10, mode=release]",
+    ] == [cell.name() for cell in cells]
+
+
+def test_matrix_must_be_a_mapping() -> None:
+    config = dedent(
+        """
+        name: tests
+        matrix:
+            - python: "3.8"
+    """
+    )
+    with pytest.raises(ValueError, match="must map variable names"):
+        Build(load_resource(config)).matrix()
+
+
+def test_matrix_axis_without_values_fails() -> None:
+    config = dedent(
+        """
+        name: tests
+        matrix:
+            python: []
+    """
+    )
+    with pytest.raises(ValueError, match="python has no values"):
+        Build(load_resource(config)).matrix()